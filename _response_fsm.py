@@ -0,0 +1,114 @@
+# CR-LF framing state machine for the responses of the LTE module.
+# This module only contains the viper kernels used for every response, so that it can be precompiled into native code and shipped as _response_fsm.mpy:
+#   mpy-cross -march=armv7emsp -X emit=native _response_fsm.py
+# The source file works as well, in which case the viper emitter compiles the kernels at import time.
+
+try:
+    from mpy_builtins import const, micropython, ptr8, ptr32
+except:
+    import micropython
+
+# Module level constants are folded into viper code, while class attributes are not visible from it.
+_CR = const(0x0d)
+_LF = const(0x0a)
+
+# Indices of the scanner context passed to scan_frame. They are exported to the caller, which fills the context.
+CTX_HEAD = const(0)
+CTX_TAIL = const(1)
+CTX_STATE = const(2)
+CTX_LENGTH = const(3)
+CTX_OFFSET = const(4)
+CTX_LIMIT = const(5)
+CTX_SIZE = const(6)
+
+# Actions of the framing state machine.
+_ACT_NONE = const(0)
+_ACT_STORE = const(1)   # Store the byte into the response.
+_ACT_EOL = const(2)     # CR after the response body. Go to state 4, or back to 1 if the body is empty.
+_ACT_RESET = const(3)   # Discard the response.
+_ACT_DONE = const(4)    # The response has been completed.
+
+# Transition table indexed by state*3 + class, where the class of a byte is CR=0, LF=1 and others=2.
+# Each entry holds the next state in the low nibble and the action in the high nibble.
+_FSM_TABLE = bytes((
+    0x01, 0x00, 0x00,   # 0: Waiting CR
+    0x01, 0x02, 0x30,   # 1: Waiting LF
+    0x24, 0x12, 0x12,   # 2: Receiving the response body
+    0x04, 0x03, 0x03,   # 3: Buffer full. Skipping the rest of the body
+    0x04, 0x44, 0x04,   # 4: Waiting LF which terminates the response
+))
+
+@micropython.viper
+def scan_frame(src:ptr8, dst:ptr8, ctx:ptr32) -> int:
+    # Runs the CR-LF framing state machine over src[head:tail] and stores the response body into dst[offset:limit].
+    # Returns 1 when a response has been completed, otherwise 0. The context is updated to resume the scan.
+    table = ptr8(_FSM_TABLE)
+    head = ctx[CTX_HEAD]
+    tail = ctx[CTX_TAIL]
+    state = ctx[CTX_STATE]
+    length = ctx[CTX_LENGTH]
+    offset = ctx[CTX_OFFSET]
+    limit = ctx[CTX_LIMIT]
+    done = 0
+    while head < tail:
+        c = src[head]
+        head += 1
+        if c == _CR:
+            entry = table[state*3]
+        elif c == _LF:
+            entry = table[state*3 + 1]
+        else:
+            entry = table[state*3 + 2]
+        state = entry & 0x0f
+        action = entry >> 4
+        if action == _ACT_STORE:
+            dst[offset+length] = c
+            length += 1
+            if offset+length == limit:
+                state = 3
+        elif action == _ACT_EOL:
+            if length == 0:
+                state = 1   # Maybe there is another corresponding CR-LF followed by actual response data. So we have to return to state 1.
+        elif action == _ACT_RESET:
+            length = 0
+        elif action == _ACT_DONE:
+            done = 1
+            break
+    ctx[CTX_HEAD] = head
+    ctx[CTX_STATE] = state
+    ctx[CTX_LENGTH] = length
+    return done
+
+@micropython.viper
+def match_prefix(buf:ptr8, start:int, prefix:ptr8, length:int) -> int:
+    # Returns 1 if buf[start:start+length] equals prefix[:length], otherwise 0. The caller checks the bounds.
+    # Compares bytes in place, while slicing a memoryview for == allocates a new memoryview.
+    i = 0
+    while i < length:
+        if buf[start+i] != prefix[i]:
+            return 0
+        i += 1
+    return 1
+
+@micropython.viper
+def parse_uint(buf:ptr8, start:int, end:int) -> int:
+    # Parses the decimal digits at buf[start:end] up to the first non-digit. Returns -1 if there is no digit.
+    value = 0
+    i = start
+    while i < end:
+        c = buf[i]
+        if c < 0x30 or c > 0x39:
+            break
+        value = value*10 + c - 0x30
+        i += 1
+    return value if i > start else -1
+
+@micropython.viper
+def find_byte(buf:ptr8, start:int, end:int, c:int) -> int:
+    # Returns the index of the first c in buf[start:end], or -1 if not found.
+    i = start
+    while i < end:
+        if buf[i] == c:
+            return i
+        i += 1
+    return -1
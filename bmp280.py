@@ -1,11 +1,25 @@
 import logging
 import struct
 try:
-    from mpy_builtins import machine, pyb, const
+    from mpy_builtins import machine, pyb, const, micropython
     from typing import Tuple, Callable, List
 except:
     import pyb
     import machine
+    import micropython
+
+# MicroPython's struct module has no Struct type, so keep the formats in one place
+# and decode straight from the I2C buffers with unpack_from.
+_CAL = '<HhhHhhhhhhhh'
+_RAW = '>HBHB'
+
+@micropython.viper
+def _compensate_temperature(adc_T:int, dig_T1:int, dig_T2:int, dig_T3:int) -> int:
+    # Returns t_fine. The temperature part of the datasheet formula fits in 32-bit integers.
+    v1 = (((adc_T >> 3) - (dig_T1 << 1))*dig_T2) >> 11
+    d = (adc_T >> 4) - dig_T1
+    v2 = (((d*d) >> 12)*dig_T3) >> 14
+    return v1 + v2
 
 class BMP280(object):
     "BMP280 Digital Pressure sensor driver"
@@ -43,6 +57,9 @@ class BMP280(object):
         self.__l = logging.Logger('BMP280')
         self.__i2c = i2c
         self.__address = address
+        self.__readfrom_mem_into = i2c.readfrom_mem_into
+        self.__raw_buf = bytearray(6)
+        self.__raw_mv = memoryview(self.__raw_buf)
         
 
     def reset(self) -> bool:
@@ -56,19 +73,7 @@ class BMP280(object):
         calibration_bytes = self.__i2c.readfrom_mem(self.__address, 0x88, 26)
         if len(calibration_bytes) != 26:
             return False
-        cal = struct.unpack('<HhhHhhhhhhhh', calibration_bytes)
-        self.__dig_T1 = float(cal[ 0])
-        self.__dig_T2 = float(cal[ 1])
-        self.__dig_T3 = float(cal[ 2])
-        self.__dig_P1 = float(cal[ 3])
-        self.__dig_P2 = float(cal[ 4])
-        self.__dig_P3 = float(cal[ 5])
-        self.__dig_P4 = float(cal[ 6])
-        self.__dig_P5 = float(cal[ 7])
-        self.__dig_P6 = float(cal[ 8])
-        self.__dig_P7 = float(cal[ 9])
-        self.__dig_P8 = float(cal[10])
-        self.__dig_P9 = float(cal[11])
+        self.__cal = struct.unpack_from(_CAL, calibration_bytes, 0)
         
         return True
 
@@ -76,54 +81,60 @@ class BMP280(object):
         "Configure this BMP280 device"
         # Enter to SLEEP mode to update config register.
         self.__i2c.writeto(self.__address, bytes((0xf4, 0x00)))
-        # Update config register and ctrl_meas register.
+        # Update config register and ctrl_meas register in one transaction.
+        # BMP280 takes register address/data pairs in a multi-byte write, so config is written before leaving SLEEP mode.
         config = ((standby_period&7) << 5) | ((iir_coefficient&7) << 2)
-        self.__i2c.writeto(self.__address, bytes((0xf5, config)))
         ctrl_meas = ((oversampling_temperature&7) << 5) | ((oversampling_pressure&7) << 2) | (power_mode&3)
-        self.__i2c.writeto(self.__address, bytes((0xf4, ctrl_meas)))
+        self.__i2c.writeto(self.__address, bytes((0xf5, config, 0xf4, ctrl_meas)))
         
     
-    def read_raw(self) -> bytes:
-        "Read measured data from this device and return it without calibration."
+    def read_raw(self) -> memoryview:
+        "Read measured data from this device and return it without calibration. The returned buffer is reused by the next read."
         try:
-            return self.__i2c.readfrom_mem(self.__address, 0xf7, 6)
+            self.__readfrom_mem_into(self.__address, 0xf7, self.__raw_buf)
+            return self.__raw_mv
         except OSError:
             return None
 
+    @micropython.native
     def read(self) -> (float, float):
         "Read measured data and calculate calibrated values. This function returns 2-ple whose first element is measured pressure value in [P] and second element is measured temperature value in [C]."
         raw = self.read_raw()
         if raw is None:
             return None
 
-        raw_P, xlsb_P, raw_T, xlsb_T = struct.unpack('>HBHB', raw)
+        raw_P, xlsb_P, raw_T, xlsb_T = struct.unpack_from(_RAW, raw, 0)
         adc_T = (raw_T << 4) | (xlsb_T >> 4)
         adc_P = (raw_P << 4) | (xlsb_P >> 4)
-        self.__l.debug("adc_T=%d, adc_P=%d", adc_T, adc_P)
-
-        # Calibration formula from BMP280 datasheet.
-        v1 = ((adc_T/16384.0) - (self.__dig_T1/1024.0))*self.__dig_T2
-        v2 = (adc_T/131072.0) - (self.__dig_T1/8192.0)
-        v2 = v2*v2*self.__dig_T3
-        t_fine = v1 + v2
-        T = (v1 + v2)/5120.0
-
-        v1 = t_fine/2.0 - 64000.0
-        v2 = v1*v1*self.__dig_P6/32768.0
-        v2 = v2 + v1*self.__dig_P5*2.0
-        v2 = v2/4.0 + self.__dig_P4*65536.0
-        v1 = (self.__dig_P3*v1*v1/524288.0 + self.__dig_P2*v1)/524288.0
-        v1 = (1.0 + v1/32768.0)*self.__dig_P1
-        if v1 == 0.0:
-            P = 0.0
+        debug = self.__l.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.__l.debug("adc_T=%d, adc_P=%d", adc_T, adc_P)
+
+        dig_T1, dig_T2, dig_T3, dig_P1, dig_P2, dig_P3, dig_P4, dig_P5, dig_P6, dig_P7, dig_P8, dig_P9 = self.__cal
+
+        # Fixed-point calibration formula from BMP280 datasheet.
+        # T is in 0.01[C] and P is in Q24.8 format [Pa].
+        t_fine = _compensate_temperature(adc_T, dig_T1, dig_T2, dig_T3)
+        T = (t_fine*5 + 128) >> 8
+
+        # The pressure part needs 64-bit intermediates, so it stays on Python integers.
+        v1 = t_fine - 128000
+        v2 = v1*v1*dig_P6
+        v2 = v2 + ((v1*dig_P5) << 17)
+        v2 = v2 + (dig_P4 << 35)
+        v1 = ((v1*v1*dig_P3) >> 8) + ((v1*dig_P2) << 12)
+        v1 = (((1 << 47) + v1)*dig_P1) >> 33
+        if v1 == 0:
+            P = 0
         else:
-            P = 1048576.0 - adc_P
-            P = (P - (v2 / 4096.0)) * 6250.0 / v1
-            self.__l.debug("P_before_comp: %f", P)
-            v1 = self.__dig_P9*P*P/2147483648.0
-            v2 = P*self.__dig_P8/32768.0
-            P = P + (v1 + v2  + self.__dig_P7)/16.0
-        return (P, T)
+            P = 1048576 - adc_P
+            P = (((P << 31) - v2)*3125)//v1
+            if debug:
+                self.__l.debug("P_before_comp: %d", P)
+            v1 = (dig_P9*(P >> 13)*(P >> 13)) >> 25
+            v2 = (dig_P8*P) >> 19
+            P = ((P + v1 + v2) >> 8) + (dig_P7 << 4)
+        return (P/256.0, T/100.0)
 
         
 
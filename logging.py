@@ -28,8 +28,11 @@ class Logger:
             return _level_dict[level]
         return "LVL" + str(level)
 
+    def isEnabledFor(self, level):
+        return level >= (self.level or _level)
+
     def log(self, level, msg, *args):
-        if level >= (self.level or _level):
+        if self.isEnabledFor(level):
             print(("%s:%s:" + msg) % ((self._level_str(level), self.name) + args), file=_stream)
 
     def debug(self, msg, *args):
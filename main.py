@@ -7,6 +7,7 @@ import struct
 import uasyncio as asyncio
 import time
 import gc
+import micropython
 
 try:
     from mpy_builtins import *
@@ -38,14 +39,18 @@ sensor_bmp.reset()
 sensor_bmp.configure()
 
 # Initialize humidity sensor
-pin_d38 = pyb.Pin('D38')    # D38:SCL
-pin_d39 = pyb.Pin('D39')    # D39:SDA
-i2c_d38 = machine.I2C(scl=pin_d38, sda=pin_d39)
+# Share the barometer's I2C bus if SHT31 (0x44 or 0x45) is connected to it. Otherwise use D38/D39.
+i2c_sht31 = i2c
+address_sht31 = [address for address in i2c.scan() if address == 0x44 or address == 0x45]
+if len(address_sht31) == 0:
+    pin_d38 = pyb.Pin('D38')    # D38:SCL
+    pin_d39 = pyb.Pin('D39')    # D39:SDA
+    i2c_sht31 = machine.I2C(scl=pin_d38, sda=pin_d39)
+    address_sht31 = i2c_sht31.scan()
 
-address_sht31 = i2c_d38.scan()
 if len(address_sht31) > 0:
     l.info("Found SHT31 at address %02x", address_sht31[0])
-    sensor_sht = SHT31(i2c_d38, address_sht31[0])
+    sensor_sht = SHT31(i2c_sht31, address_sht31[0])
     sensor_sht.stop_measurement()
     if not sensor_sht.reset():
         l.error("Failed to reset SHT31")
@@ -56,67 +61,91 @@ if len(address_sht31) > 0:
         sensor_sht = None
 else:
     l.error("Failed to detect SHT31")
+    sensor_sht = None
 
+_U16 = '>H'
+# CONNECT variable header: protocol name, protocol level, connect flags and keep alive.
+_CONNECT_HEADER = '>H4sBBH'
+
+@micropython.native
 def put_string(buffer:memoryview, length:int, utf8:bytes) -> int:
-    struct.pack_into('>H', buffer, 0, length)
+    struct.pack_into(_U16, buffer, 0, length)
     if length > 0:
         buffer[2:2+length] = utf8
-        return length + 2
-    else:
-        return 2
+    return length + 2
 
 def get_string(buffer:memoryview) -> Tuple[int, memoryview]:
-    length = struct.unpack_from('>H', buffer)
+    length = (buffer[0] << 8) | buffer[1]
     if length == 0 :
-        return (2, '')
+        return (2, b'')
     else:
         return (2 + length, buffer[2:2+length])
 
-def put_remaining_length(buffer:memoryview, remaining_length:int) -> int:
-    if remaining_length < 0:
-        raise ValueError()
-    
+@micropython.viper
+def _put_remaining_length(buffer:ptr8, offset:int, remaining_length:int) -> int:
+    # Returns the number of bytes written at buffer[offset:].
     count = 0
-    while count == 0 or remaining_length > 0:
+    while True:
         byte = remaining_length & 0x7f
         remaining_length >>= 7
-        if remaining_length > 0:
-            byte |= 0x80
-        buffer[count] = byte
+        if remaining_length == 0:
+            buffer[offset+count] = byte
+            return count + 1
+        buffer[offset+count] = byte | 0x80
         count += 1
-    return count
 
-def get_remaining_length(buffer:memoryview) -> Tuple[int,int]:
-    index = 0
+@micropython.viper
+def _get_remaining_length(buffer:ptr8, offset:int) -> int:
+    # Returns (remaining_length << 3) | encoded_length, or -1 if the encoding is longer than 4 bytes.
     remaining_length = 0
     shift = 0
-    byte = 0x80
-    while (byte & 0x80) != 0:
-        byte = buffer[index]
-        remaining_length += (byte & 0x7f) << shift
+    index = 0
+    while True:
+        byte = int(buffer[offset+index])
+        remaining_length |= (byte & 0x7f) << shift
+        index += 1
+        if (byte & 0x80) == 0:
+            return (remaining_length << 3) | index
         shift += 7
         if shift > 21:
-            raise ValueError("Invalid remaining length")
-        index += 1
-    return (index, remaining_length)
+            return -1
+
+def put_remaining_length(buffer:memoryview, remaining_length:int) -> int:
+    if remaining_length < 0:
+        raise ValueError()
+    return _put_remaining_length(buffer, 0, remaining_length)
 
+def get_remaining_length(buffer:memoryview) -> Tuple[int,int]:
+    packed = _get_remaining_length(buffer, 0)
+    if packed < 0:
+        raise ValueError("Invalid remaining length")
+    return (packed & 7, packed >> 3)
 
+
+@micropython.native
 def put_fixed_header(buffer:memoryview, packet_type:int, flags:int, remaining_length:int) -> int:
+    if remaining_length < 0:
+        raise ValueError()
     buffer[0] = (packet_type << 4) | flags
-    return put_remaining_length(buffer[1:], remaining_length) + 1
+    return _put_remaining_length(buffer, 1, remaining_length) + 1
 
 def get_fixed_header(buffer:memoryview) -> Tuple[int, Tuple[int, int, int]]:
     packet_type = buffer[0] >> 4
     flags = buffer[0] & 0xf
-    index, remaining_length = get_remaining_length(buffer[1:])
-    return (index + 1, (packet_type, flags, remaining_length))
+    packed = _get_remaining_length(buffer, 1)
+    if packed < 0:
+        raise ValueError("Invalid remaining length")
+    return ((packed & 7) + 1, (packet_type, flags, packed >> 3))
 
 def put_packet_id(buffer:memoryview, packet_id:int) -> int:
-    struct.pack_into('>H', buffer, packet_id)
+    struct.pack_into(_U16, buffer, 0, packet_id)
     return 2
 
 async def receive_response(m:LTEModule, conn:int, buffer:memoryview, timeout:int=None) -> Tuple[Tuple[int, int, int], memoryview]:
     length = await m.socket_receive(conn, buffer, 0, 4, timeout)
+    if length == 0 and await m.socket_wait_receive(conn, timeout):
+        # Nothing was buffered yet. Read again after the module has reported incoming data.
+        length = await m.socket_receive(conn, buffer, 0, 4, timeout)
     if length is None or length < 2:
         return None, None
     i, (packet_type, flags, remaining_length) = get_fixed_header(buffer)
@@ -154,8 +183,9 @@ class ConnectFlags(object):
     CleanSession = const(0x02)
 
 
+@micropython.native
 def make_connect(buffer:bytearray, client_name:str, user_name:str=None, password:str=None, keep_alive:int=10) -> int:
-    client_name_bytes = bytes(client_name, 'utf-8')
+    client_name_bytes = client_name if isinstance(client_name, (bytes, bytearray)) else bytes(client_name, 'utf-8')
     client_name_length = len(client_name_bytes) + 2
     user_name_bytes = bytes(user_name, 'utf-8') if user_name is not None else None
     user_name_length = len(user_name_bytes) + 2 if user_name is not None else 0
@@ -169,10 +199,7 @@ def make_connect(buffer:bytearray, client_name:str, user_name:str=None, password
     mv = memoryview(buffer)
     i = 0
     i += put_fixed_header(mv[i:], ControlPacketType.CONNECT, 0, remaining_length)
-    i += put_string(mv[i:], 4, b'MQTT')
-    mv[i] = 4; i += 1        # Protocol Version
-    mv[i] = flags; i += 1    # Flags
-    struct.pack_into('>H', mv, i, keep_alive); i += 2   # Keep Alive
+    struct.pack_into(_CONNECT_HEADER, mv, i, 4, b'MQTT', 4, flags, keep_alive); i += 10
     i += put_string(mv[i:], client_name_length-2, client_name_bytes)  # Client Name
     if user_name_bytes is not None:
         i += put_string(mv[i:], user_name_length-2, user_name_bytes)    # User Name
@@ -187,19 +214,51 @@ def make_disconnect(buffer:bytearray) -> int:
     return 2
 
 
-def make_publish(buffer:bytearray, topic:str, payload:bytes=None, payload_length:int=None) -> int:
-    topic_bytes = bytes(topic, 'utf-8')
+@micropython.native
+def make_publish(buffer:bytearray, topic_bytes:bytes, payload:bytes=None, payload_length:int=None) -> int:
     topic_length = len(topic_bytes)
     payload_length = 0 if payload is None else (len(payload) if payload_length is None else payload_length)
     remaining_length = topic_length + 2 + payload_length
 
     mv = memoryview(buffer)
-    i = 0
-    i += put_fixed_header(mv[i:], ControlPacketType.PUBLISH, 0, remaining_length)
-    i += put_string(mv[i:], topic_length, topic_bytes)
-    mv[i:i+payload_length] = payload
+    header_length = put_fixed_header(mv, ControlPacketType.PUBLISH, 0, remaining_length)
+    payload_offset = header_length + put_string(mv[header_length:], topic_length, topic_bytes)
+    if payload_length > 0:
+        mv[payload_offset:payload_offset+payload_length] = memoryview(payload)[:payload_length]
     
-    return remaining_length + 2
+    return payload_offset + payload_length
+
+def make_publish_template(buffer:bytearray, topic_bytes:bytes) -> Callable[[bytes], Tuple[int, int]]:
+    # Writes the topic once and returns a function which only splices the payload and the fixed header.
+    # The returned function gives (offset, length) of the PUBLISH packet in the buffer.
+    # The fixed header is right-aligned to the 5 bytes reserved in front of the topic.
+    topic_length = len(topic_bytes)
+    mv = memoryview(buffer)
+    payload_offset = 5 + put_string(mv[5:], topic_length, topic_bytes)
+
+    def fill(payload:bytes, payload_length:int=None) -> Tuple[int, int]:
+        payload_length = len(payload) if payload_length is None else payload_length
+        if payload_length > 0:
+            mv[payload_offset:payload_offset+payload_length] = memoryview(payload)[:payload_length]
+        remaining_length = topic_length + 2 + payload_length
+        count = 1
+        rest = remaining_length >> 7
+        while rest > 0:
+            count += 1
+            rest >>= 7
+        offset = 4 - count
+        mv[offset] = ControlPacketType.PUBLISH << 4
+        _put_remaining_length(mv, offset + 1, remaining_length)
+        return (offset, payload_offset + payload_length - offset)
+    return fill
+
+_CLIENT_NAME = b'wiolte'
+_TOPIC = b'devices/wiolte/messages/events/'
+
+# I/O buffer shared by the packet builders and receive_response.
+_IO = bytearray(1536)
+_SEND = memoryview(_IO)[:1024]
+_RECV = memoryview(_IO)[1024:]
 
 async def main_task():
     while not await m.turn_on_or_reset():
@@ -216,26 +275,21 @@ async def main_task():
     
     log.info('LTE network has been activated.')
 
-    buffer = bytearray(1024)
-
     while True:
         connected = False
         while not connected:
             conn = await m.socket_open('beam.soracom.io', 1883, m.SOCKET_TCP)
             log.info('Connection to SORACOM Beam = {0}'.format(conn))
     
-            length = make_connect(buffer, client_name="wiolte", keep_alive=120)
-            log.debug("CONNECT: %s", buffer[:length])
-            if not await m.socket_send(conn, buffer, offset=0, length=length, timeout=1000):
+            length = make_connect(_SEND, client_name=_CLIENT_NAME, keep_alive=120)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("CONNECT: %s", bytes(_SEND[:length]))
+            if not await m.socket_send(conn, _SEND, offset=0, length=length, timeout=1000):
                 await m.socket_close(conn, timeout=1000)
                 continue
             
-            for i in range(10):
-                response, body = await receive_response(m, conn, buffer, timeout=1000)
-                if response is None:
-                    await asyncio.sleep_ms(100)
-                    continue
-            
+            response, body = await receive_response(m, conn, _RECV, timeout=5000)
+            if response is not None:
                 packet_type, flags, remaining_length = response
                 log.debug("RESPONSE: %x, %x, %d", packet_type, flags, remaining_length)
                 if packet_type == ControlPacketType.CONNACK and remaining_length == 2:
@@ -245,14 +299,14 @@ async def main_task():
                     else:
                         log.info("CONNECT success")
                     connected = return_code == 0
-                    break
                 
             if not connected:
-                length = make_disconnect(buffer)
-                await m.socket_send(conn, buffer, offset=0, length=length, timeout=5000)
+                length = make_disconnect(_SEND)
+                await m.socket_send(conn, _SEND, offset=0, length=length, timeout=5000)
                 await m.socket_close(conn, timeout=1000)
                 await asyncio.sleep_ms(5000)
 
+        publish = make_publish_template(_SEND, _TOPIC)
         while m.socket_is_connected(conn):
             sht_value = sensor_sht.read() if sensor_sht is not None else None
             bmp_value = sensor_bmp.read() if sensor_bmp is not None else None
@@ -264,8 +318,8 @@ async def main_task():
 
             payload = '{{"temperature":{0},"humidity":{1},"pressure":{2}}}'.format(temperature, humidity, pressure)
             log.info("PUBLISH: %s", payload)
-            length = make_publish(buffer, 'devices/wiolte/messages/events/', bytes(payload, 'utf-8'))
-            if not await m.socket_send(conn, buffer, length=length, timeout=5000):
+            offset, length = publish(bytes(payload, 'utf-8'))
+            if not await m.socket_send(conn, _SEND, offset=offset, length=length, timeout=5000):
                 break
             
             gc.collect()
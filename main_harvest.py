@@ -6,6 +6,7 @@ import logging
 import struct
 import uasyncio as asyncio
 import time
+import ujson
 
 try:
     from mpy_builtins import *
@@ -37,14 +38,18 @@ sensor_bmp.reset()
 sensor_bmp.configure()
 
 # Initialize humidity sensor
-pin_d38 = pyb.Pin('D38')    # D38:SCL
-pin_d39 = pyb.Pin('D39')    # D39:SDA
-i2c_d38 = machine.I2C(scl=pin_d38, sda=pin_d39)
+# Share the barometer's I2C bus if SHT31 (0x44 or 0x45) is connected to it. Otherwise use D38/D39.
+i2c_sht31 = i2c
+address_sht31 = [address for address in i2c.scan() if address == 0x44 or address == 0x45]
+if len(address_sht31) == 0:
+    pin_d38 = pyb.Pin('D38')    # D38:SCL
+    pin_d39 = pyb.Pin('D39')    # D39:SDA
+    i2c_sht31 = machine.I2C(scl=pin_d38, sda=pin_d39)
+    address_sht31 = i2c_sht31.scan()
 
-address_sht31 = i2c_d38.scan()
 if len(address_sht31) > 0:
     l.info("Found SHT31 at address %02x", address_sht31[0])
-    sensor_sht = SHT31(i2c_d38, address_sht31[0])
+    sensor_sht = SHT31(i2c_sht31, address_sht31[0])
     sensor_sht.stop_measurement()
     if not sensor_sht.reset():
         l.error("Failed to reset SHT31")
@@ -55,6 +60,12 @@ if len(address_sht31) > 0:
         sensor_sht = None
 else:
     l.error("Failed to detect SHT31")
+    sensor_sht = None
+
+# I/O buffer shared by the payload and the response.
+_IO = bytearray(1536)
+_SEND = memoryview(_IO)[:1024]
+_RECV = memoryview(_IO)[1024:]
 
 async def main_task():
     # Wait until the LTE module gets ready to communicate.
@@ -73,7 +84,7 @@ async def main_task():
     
     log.info('LTE network has been activated.')
 
-    buffer = bytearray(1024)
+    sample = {'temperature': None, 'humidity': None, 'pressure': None}
     while True:
         connected = False
         # Connect to SORACOM Harvest endpoint.
@@ -91,23 +102,27 @@ async def main_task():
             sht_value = sensor_sht.read() if sensor_sht is not None else None
             bmp_value = sensor_bmp.read() if sensor_bmp is not None else None
 
-            temperature = sht_value[0] if sht_value is not None else 'null'
-            humidity    = sht_value[1] if sht_value is not None else 'null'
-            pressure    = bmp_value[0] if bmp_value is not None else 'null'
-            temperature = bmp_value[1] if bmp_value is not None else temperature
+            sample['temperature'] = sht_value[0] if sht_value is not None else None
+            sample['humidity']    = sht_value[1] if sht_value is not None else None
+            sample['pressure']    = bmp_value[0] if bmp_value is not None else None
+            if bmp_value is not None:
+                sample['temperature'] = bmp_value[1]
 
             # Construct data to transmit to SORACOM Harvest
-            payload = '{{"temperature":{0},"humidity":{1},"pressure":{2}}}\n'.format(temperature, humidity, pressure)
+            payload = ujson.dumps(sample)
             log.info("Send: %s", payload)
             payload_bytes = bytes(payload, 'utf-8')
+            length = len(payload_bytes)
+            _SEND[:length] = payload_bytes
+            _SEND[length] = 0x0a   # LF
             # Transmit data
-            if not await m.socket_send(conn, payload_bytes, length=len(payload_bytes), timeout=5000):
+            if not await m.socket_send(conn, _SEND, length=length+1, timeout=5000):
                 break
             # Receive response.
-            length = await m.socket_receive(conn, buffer, timeout=5000)
+            length = await m.socket_receive(conn, _RECV, timeout=5000)
             if length is not None:
-                if buffer[:length] != b'201':
-                    log.error('ERROR: invalid response - %s', buffer[:length])
+                if _RECV[:length] != b'201':
+                    log.error('ERROR: invalid response - %s', bytes(_RECV[:length]))
             # Wake up after 120[s] 
             await asyncio.sleep_ms(1000*60*2)
 
@@ -6,5 +6,13 @@ Defines MicroPython builtin types for better editor code completion.
 def const(value):
     return value
 
+class ptr8(object):
+    "8-bit pointer type used by viper functions"
+class ptr16(object):
+    "16-bit pointer type used by viper functions"
+class ptr32(object):
+    "32-bit pointer type used by viper functions"
+
 import pyb
 import machine
+import micropython
@@ -0,0 +1,12 @@
+"""
+micropython module in MicroPython
+"""
+
+def const(value):
+    return value
+def native(f):
+    "Compile the function with the native code emitter"
+    return f
+def viper(f):
+    "Compile the function with the viper code emitter"
+    return f
@@ -63,6 +63,9 @@ class Pin(object):
     PULL_UP = 1
     PULL_DOWN = 2
 
+    IRQ_RISING = 0x10110000
+    IRQ_FALLING = 0x10210000
+
     @classmethod
     def debug(cls, state:bool=True)->None:
         pass
@@ -89,10 +92,13 @@ class Pin(object):
         pass
     def off(self)->None:
         pass
+    def irq(self, handler:Callable[['Pin'],None]=None, trigger:int=IRQ_RISING|IRQ_FALLING, hard:bool=False)->Callable[['Pin'],None]:
+        return None
 
 class UART(object):
     RTS = 256
     CTS = 512
+    IRQ_RXIDLE = 16
     
     def __init__(self, bus:int, **kwargs):
         self.__bus = bus
@@ -116,3 +122,5 @@ class UART(object):
         return None
     def sendbreak(self) -> None:
         return None
+    def irq(self, handler:Callable[['UART'],None]=None, trigger:int=IRQ_RXIDLE, hard:bool=False)->Callable[['UART'],None]:
+        return None
@@ -1,5 +1,4 @@
 import logging
-import struct
 try:
     from mpy_builtins import machine, pyb, const
     from typing import Tuple, Callable, List
@@ -7,6 +6,30 @@ except:
     import pyb
     import machine
 
+# CRC-8 of every byte value for SHT3x (polynomial 0x31, MSB first).
+_CRC8_TABLE = (
+    b'\x00\x31\x62\x53\xc4\xf5\xa6\x97\xb9\x88\xdb\xea\x7d\x4c\x1f\x2e'
+    b'\x43\x72\x21\x10\x87\xb6\xe5\xd4\xfa\xcb\x98\xa9\x3e\x0f\x5c\x6d'
+    b'\x86\xb7\xe4\xd5\x42\x73\x20\x11\x3f\x0e\x5d\x6c\xfb\xca\x99\xa8'
+    b'\xc5\xf4\xa7\x96\x01\x30\x63\x52\x7c\x4d\x1e\x2f\xb8\x89\xda\xeb'
+    b'\x3d\x0c\x5f\x6e\xf9\xc8\x9b\xaa\x84\xb5\xe6\xd7\x40\x71\x22\x13'
+    b'\x7e\x4f\x1c\x2d\xba\x8b\xd8\xe9\xc7\xf6\xa5\x94\x03\x32\x61\x50'
+    b'\xbb\x8a\xd9\xe8\x7f\x4e\x1d\x2c\x02\x33\x60\x51\xc6\xf7\xa4\x95'
+    b'\xf8\xc9\x9a\xab\x3c\x0d\x5e\x6f\x41\x70\x23\x12\x85\xb4\xe7\xd6'
+    b'\x7a\x4b\x18\x29\xbe\x8f\xdc\xed\xc3\xf2\xa1\x90\x07\x36\x65\x54'
+    b'\x39\x08\x5b\x6a\xfd\xcc\x9f\xae\x80\xb1\xe2\xd3\x44\x75\x26\x17'
+    b'\xfc\xcd\x9e\xaf\x38\x09\x5a\x6b\x45\x74\x27\x16\x81\xb0\xe3\xd2'
+    b'\xbf\x8e\xdd\xec\x7b\x4a\x19\x28\x06\x37\x64\x55\xc2\xf3\xa0\x91'
+    b'\x47\x76\x25\x14\x83\xb2\xe1\xd0\xfe\xcf\x9c\xad\x3a\x0b\x58\x69'
+    b'\x04\x35\x66\x57\xc0\xf1\xa2\x93\xbd\x8c\xdf\xee\x79\x48\x1b\x2a'
+    b'\xc1\xf0\xa3\x92\x05\x34\x67\x56\x78\x49\x1a\x2b\xbc\x8d\xde\xef'
+    b'\x82\xb3\xe0\xd1\x46\x77\x24\x15\x3b\x0a\x59\x68\xff\xce\x9d\xac'
+)
+
+def _crc8(b0:int, b1:int) -> int:
+    "Calculate CRC-8 of a 16-bit word with initial value 0xff."
+    return _CRC8_TABLE[_CRC8_TABLE[0xff ^ b0] ^ b1]
+
 class SHT31(object):
     REPEATABILITY_HIGH = const(0)
     REPEATABILITY_MEDIUM = const(1)
@@ -24,47 +47,43 @@ class SHT31(object):
         0x23,
         0x27,
     ]
-    PERIODIC_LSB = {
-        (REPEATABILITY_HIGH  , MPS_0_5): 0x32,
-        (REPEATABILITY_MEDIUM, MPS_0_5): 0x24,
-        (REPEATABILITY_LOW   , MPS_0_5): 0x2f,
-        (REPEATABILITY_HIGH  , MPS_1  ): 0x30,
-        (REPEATABILITY_MEDIUM, MPS_1  ): 0x26,
-        (REPEATABILITY_LOW   , MPS_1  ): 0x2d,
-        (REPEATABILITY_HIGH  , MPS_2  ): 0x36,
-        (REPEATABILITY_MEDIUM, MPS_2  ): 0x20,
-        (REPEATABILITY_LOW   , MPS_2  ): 0x2b,
-        (REPEATABILITY_HIGH  , MPS_4  ): 0x34,
-        (REPEATABILITY_MEDIUM, MPS_4  ): 0x22,
-        (REPEATABILITY_LOW   , MPS_4  ): 0x29,
-        (REPEATABILITY_HIGH  , MPS_10 ): 0x37,
-        (REPEATABILITY_MEDIUM, MPS_10 ): 0x21,
-        (REPEATABILITY_LOW   , MPS_10 ): 0x2a,
-    }
+    # LSB of the periodic measurement command indexed by repeatability*5 + mps.
+    PERIODIC_LSB = (
+        b'\x32\x30\x36\x34\x37'   # REPEATABILITY_HIGH   : MPS_0_5, MPS_1, MPS_2, MPS_4, MPS_10
+        b'\x24\x26\x20\x22\x21'   # REPEATABILITY_MEDIUM
+        b'\x2f\x2d\x2b\x29\x2a'   # REPEATABILITY_LOW
+    )
     def __init__(self, i2c:machine.I2C, address:int):
         self.__l = logging.Logger('SHT31')
         self.__i2c = i2c
         self.__address = address
+        self.__cmd = bytearray(2)
+
+    def __write_command(self, msb:int, lsb:int) -> bool:
+        cmd = self.__cmd
+        cmd[0] = msb
+        cmd[1] = lsb
+        return self.__i2c.writeto(self.__address, cmd, True) == 2
 
     def reset(self) -> bool:
-        return self.__i2c.writeto(self.__address, bytes((0x30, 0xa2)), True) == 2
+        return self.__write_command(0x30, 0xa2)
 
     def start_measurement(self, repeatability:int=REPEATABILITY_LOW, mps:int=MPS_1):
         if mps < 0 or len(SHT31.PERIODIC_MSB) <= mps:
             raise ValueError()
-        if (repeatability, mps) not in SHT31.PERIODIC_LSB:
+        if repeatability < 0 or SHT31.REPEATABILITY_LOW < repeatability:
             raise ValueError()
         msb = SHT31.PERIODIC_MSB[mps]
-        lsb = SHT31.PERIODIC_LSB[(repeatability, mps)]
+        lsb = SHT31.PERIODIC_LSB[repeatability*5 + mps]
 
-        return self.__i2c.writeto(self.__address, bytes((msb, lsb)), True) == 2
+        return self.__write_command(msb, lsb)
 
     def stop_measurement(self):
-        return self.__i2c.writeto(self.__address, bytes((0x30, 0x93)), True) == 2
+        return self.__write_command(0x30, 0x93)
 
     def set_heater(self, enable_heater:bool) -> bool:
         lsb = 0x6d if enable_heater else 0x66
-        return self.__i2c.writeto(self.__address, bytes((0x30, lsb)), True) == 2
+        return self.__write_command(0x30, lsb)
 
     def read_raw(self) -> bytes:
         try:
@@ -72,12 +91,19 @@ class SHT31(object):
         except OSError:
             return None
 
-    def read(self) -> (float, float):
+    def read(self, scaled:bool=True) -> (float, float):
+        "Read temperature [degC] and relative humidity [%]. Returns the raw 16-bit words if scaled is False."
         raw = self.read_raw()
         if raw is None:
             return (None, None)
-        values = struct.unpack('>HBHB', raw)
+        if _crc8(raw[0], raw[1]) != raw[2] or _crc8(raw[3], raw[4]) != raw[5]:
+            self.__l.info('CRC mismatch')
+            return (None, None)
+        temperature = (raw[0] << 8) | raw[1]
+        humidity = (raw[3] << 8) | raw[4]
+        if not scaled:
+            return (temperature, humidity)
         return (
-            values[0]/65535.0*175 -45,
-            values[2]/65535.0*315 -49,
+            temperature*175/65535 - 45,
+            humidity*100/65535,
         )
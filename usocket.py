@@ -19,9 +19,9 @@ IPPROTO_UDP = const(2)
 
 __dns_cache = {}
 
-async def __wrap_async(f):
+async def __wrap_async(coro):
     try:
-        return await f()
+        return await coro
     except BaseException as e:
         return e
 
@@ -33,15 +33,18 @@ class socket(object):
         self.__conn = None
         self.__thread = None
         self.__socket_type = type
+        self.__send_buffer = None
+        self.__send_length = 0
+        self.__recv_buffer = None
 
-    def __run_async(self, f):
-        result = self.__loop.run_until_complete(__wrap_async(f))
+    def __run_async(self, coro):
+        result = self.__loop.run_until_complete(__wrap_async(coro))
         if isinstance(result, BaseException):
             raise result
         return result
     
     def connect(self, address:Tuple[str,int]):
-        conn = self.__run_async(lambda: self.__lte.socket_open(host=address[0], port=address[1], socket_type=self.__socket_type, timeout=10000))
+        conn = self.__run_async(self.__lte.socket_open(host=address[0], port=address[1], socket_type=self.__socket_type, timeout=10000))
         if conn is None:
             raise OSError("Failed to connect")
         self.__conn = conn
@@ -49,57 +52,89 @@ class socket(object):
     def send(self, data:bytes) -> int:
         if self.__conn is None:
             raise OSError("Not connected")
-        result = self.__run_async(lambda: self.__lte.socket_send(connect_id=self.__conn, data=data, timeout=10000))
+        self.flush()
+        result = self.__run_async(self.__lte.socket_send(connect_id=self.__conn, data=data, timeout=10000))
         return len(data) if result is not None else 0
 
     def sendall(self, data:bytes):
-        self.send(data)
+        "Buffer data and send it when a packet gets full or flush() is called."
+        if self.__conn is None:
+            raise OSError("Not connected")
+        if self.__send_buffer is None:
+            self.__send_buffer = memoryview(bytearray(self.__lte.MAX_SOCKET_DATA_SIZE))
+        capacity = len(self.__send_buffer)
+        mv = memoryview(data)
+        length = len(data)
+        offset = 0
+        while length - offset >= capacity - self.__send_length:
+            # Complete the packet with the head of data and send both at once.
+            n = capacity - self.__send_length
+            self.__send_chunks([self.__send_buffer[:self.__send_length], mv[offset:offset+n]])
+            offset += n
+        n = length - offset
+        self.__send_buffer[self.__send_length:self.__send_length+n] = mv[offset:]
+        self.__send_length += n
+
+    def flush(self) -> None:
+        "Send the data buffered by sendall."
+        if self.__send_length > 0:
+            self.__send_chunks([self.__send_buffer[:self.__send_length]])
+
+    def __send_chunks(self, chunks:List[bytes]) -> None:
+        self.__send_length = 0
+        if not self.__run_async(self.__lte.socket_send_batch(connect_id=self.__conn, chunks=chunks, timeout=10000)):
+            raise OSError("Failed to send")
 
     def recv(self, bufsize:int):
-        buffer = bytearray(bufsize)
-        length = self.__run_async(lambda: self.__lte.socket_receive(connect_id=self.__conn, buffer=buffer, timeout=10000))
-        mv = memoryview(buffer)
+        "Receive up to bufsize bytes. The returned memoryview is valid until the next recv call."
+        self.flush()
+        if self.__recv_buffer is None:
+            self.__recv_buffer = memoryview(bytearray(self.__lte.MAX_SOCKET_DATA_SIZE))
+        mv = self.__recv_buffer
+        if bufsize > len(mv):
+            bufsize = len(mv)
+        length = self.__run_async(self.__lte.socket_receive(connect_id=self.__conn, buffer=mv[:bufsize], timeout=10000))
         return mv[:length] if length is not None else mv[:0]
     
     def read(self, size:int):
+        buffer = bytearray(size)
+        mv = memoryview(buffer)
         bytes_read = 0
-        buffer = None
-        while True:
-            data = self.recv(size - bytes_read)
-            
-            if len(data) == size:
-                return data
-            elif bytes_read + len(data) == size:
-                return buffer
-            else:
-                if buffer is None:
-                    buffer = bytearray(size)
-                buffer[bytes_read:bytes_read+len(data)] = data
-            bytes_read += len(data)
+        timed_out = False
+        while bytes_read < size:
+            length = self.readinto(mv[bytes_read:], size - bytes_read)
+            if length > 0:
+                bytes_read += length
+                continue
+            if timed_out or not self.__lte.socket_is_connected(self.__conn):
+                # Nothing has arrived during a whole wait, or the connection has been closed.
+                break
+            # No data has arrived yet. Wait until the module reports incoming data, and read again either way.
+            timed_out = not self.__run_async(self.__lte.socket_wait_receive(connect_id=self.__conn, timeout=10000))
+        return buffer if bytes_read == size else buffer[:bytes_read]
 
 
 
     def readinto(self, buf:bytearray, nbytes:int=None) -> int:
+        self.flush()
         nbytes = len(buf) if nbytes is None else nbytes
         mv = memoryview(buf)
-        length = self.__run_async(lambda: self.__lte.socket_receive(connect_id=self.__conn, buffer=mv[:nbytes], offset=0))
+        length = self.__run_async(self.__lte.socket_receive(connect_id=self.__conn, buffer=mv[:nbytes], offset=0))
         return 0 if length is None else length
     
     def write(self, buf:bytes, *args) -> int:
-        if len(args) == 1:
-            length = args[0]
-            mv = memoryview(buf)
-            return self.send(mv[:length])
-        elif len(args) == 2:
-            offset = args[2]
-            length = args[1]
-            mv = memoryview(buf)
-            return self.send(mv[offset:offset+length])
-        else:
+        "write(buf[, length]) or write(buf, offset, length), as MicroPython streams."
+        offset = args[0] if len(args) == 2 else 0
+        length = args[-1] if len(args) > 0 else len(buf)
+        if offset == 0 and length >= len(buf):
             return self.send(buf)
+        return self.send(memoryview(buf)[offset:offset+length])
 
     def close(self) -> None:
-        self.__run_async(lambda: self.__lte.socket_close(connect_id=self.__conn, timeout=10000))
+        try:
+            self.flush()
+        finally:
+            self.__run_async(self.__lte.socket_close(connect_id=self.__conn, timeout=10000))
 
 def getaddrinfo(host:str, port:int, family:int=0, type_:int=0, proto:int=0, flags:int=0):
     import wiolte
@@ -1,6 +1,8 @@
+import array
 import logging
 import time
 import uasyncio as asyncio
+from _response_fsm import scan_frame, match_prefix, parse_uint, find_byte, CTX_HEAD, CTX_TAIL, CTX_STATE, CTX_LENGTH, CTX_OFFSET, CTX_LIMIT, CTX_SIZE
 
 try:
     from mpy_builtins import machine, pyb, const
@@ -9,6 +11,74 @@ except:
     import pyb
     import machine
 
+# Set to 1 to log AT command I/O. The compiler removes the blocks guarded by _DEBUG while it is 0.
+_DEBUG = const(0)
+
+def _dbg(msg:str, *args) -> None:
+    "Debug log of LTEModule. A no-op unless _DEBUG is set."
+    pass
+
+if _DEBUG:
+    _dbg = logging.Logger('LTEModule').debug
+
+# Largest connection ID of the module. The command tables below are indexed by the connection ID.
+_MAX_CONNECT_ID = const(12)
+
+# AT command prefixes which only depend on the connection ID.
+_QISEND_BY_ID = tuple(b'AT+QISEND=%d,' % connect_id for connect_id in range(_MAX_CONNECT_ID + 1))
+_QIRD_BY_ID = tuple(b'AT+QIRD=%d,' % connect_id for connect_id in range(_MAX_CONNECT_ID + 1))
+_QICLOSE_BY_ID = tuple(b'AT+QICLOSE=%d' % connect_id for connect_id in range(_MAX_CONNECT_ID + 1))
+# What follows the payload of AT+QIRD, and the '+QIRD: 0' line when there is no data.
+_QIRD_TRAILER = b'\r\n\r\nOK\r\n'
+_QIRD_EMPTY_TRAILER = b'\r\nOK\r\n'
+# Prefix of the URC which reports the result of AT+QIOPEN.
+_QIOPEN_RESULT_BY_ID = tuple(b'+QIOPEN: %d,' % connect_id for connect_id in range(_MAX_CONNECT_ID + 1))
+
+# Bit position of 2**n indexed by (2**n) % 37, which is unique for n < 32.
+_BIT_POSITION = b'\x00\x00\x01\x1a\x02\x17\x1b\x00\x03\x10\x18\x1e\x1c\x0b\x00\x0d\x04\x07\x11\x00\x19\x16\x1f\x0f\x1d\x0a\x0c\x06\x00\x15\x0e\x09\x05\x14\x08\x13\x12'
+
+def _parse_registration_status(response:bytes) -> int:
+    "Get <stat> from a '+CGREG: <n>,<stat>' response or a '+CGREG: <stat>' URC, and the +CEREG equivalents. Returns -1 if the response is malformed."
+    length = len(response)
+    if length == 9:
+        c = response[8]
+    elif length >= 11 and response[9] == 0x2c:
+        c = response[10]
+    else:
+        return -1
+    return c - 0x30 if 0x30 <= c and c <= 0x39 else -1
+
+def _parse_two_ints(response:bytes, start:int) -> Tuple[int,int]:
+    "Parse two decimal integers separated by a comma from response[start:], such as '+CSQ: <rssi>,<ber>'. Returns None if malformed."
+    first = -1
+    value = -1
+    for index in range(start, len(response)):
+        c = response[index]
+        if 0x30 <= c and c <= 0x39:
+            value = c - 0x30 if value < 0 else value*10 + c - 0x30
+        elif c == 0x2c and first < 0 and value >= 0:
+            first = value
+            value = -1
+        elif c != 0x20:
+            return None
+    if value < 0 or first < 0:
+        return None
+    return (first, value)
+
+def _is_ok(mv:memoryview) -> bool:
+    "The default terminator predicate of execute_command."
+    return len(mv) == 2 and mv[0] == 0x4f and mv[1] == 0x4b
+
+def _is_ok_or_error(mv:memoryview) -> bool:
+    "Terminator predicate for commands which may fail with ERROR."
+    length = len(mv)
+    if length == 2:
+        return mv[0] == 0x4f and mv[1] == 0x4b
+    return length == 5 and match_prefix(mv, 0, b'ERROR', 5) != 0
+
+# Module level constants are folded at compile time, while class attributes are looked up on every access.
+_CR = const(0x0d)
+_LF = const(0x0a)
 
 class WioLTE(object):
     "The WioLTE class to control Wio LTE on-board functions"
@@ -39,15 +109,23 @@ class LTEModuleError(RuntimeError):
         super().__init__(message)
 
 class LTEModule(object):
-    "Controls Quectel EC21 LTE Module"
-    CR = const(0x0d)
-    LF = const(0x0a)
+    """
+    Controls Quectel EC21 LTE Module
+
+    The methods share the UART and the response buffer, so callers must serialize all use of the module across tasks.
+    """
+    CR = _CR
+    LF = _LF
 
     SOCKET_TCP = const(0)
     SOCKET_UDP = const(1)
 
-    MAX_CONNECT_ID = const(12)
+    MAX_CONNECT_ID = _MAX_CONNECT_ID
     MAX_SOCKET_DATA_SIZE = const(1460)
+    RX_STAGING_SIZE = const(256)
+    RESPONSE_BUFFER_SIZE = const(1024)
+    COMMAND_BUFFER_SIZE = const(128)
+    RX_WAIT_INTERVAL = const(100)
 
     def __init__(self):
         self.__l = logging.Logger('LTEModule')
@@ -62,11 +140,27 @@ class LTEModule(object):
         
         self.__uart = pyb.UART(2)
         self.__urcs = None
-        self.__connections = []
+        self.__connection_mask = 0     # Bit n is set while the connection n is open.
+        self.__receive_pending = 0
+        # Bytes read from the UART in bulk and not consumed yet are kept in [__rx_head, __rx_tail).
+        self.__rx_buf = bytearray(LTEModule.RX_STAGING_SIZE)
+        self.__rx_mv = memoryview(self.__rx_buf)
+        self.__rx_head = 0
+        self.__rx_tail = 0
+        self.__scan_ctx = array.array('i', (0,)*CTX_SIZE)
+        # Scratch buffer shared by command responses. Responses returned as memoryview are valid until the next command.
+        self.__resp_buf = bytearray(LTEModule.RESPONSE_BUFFER_SIZE)
+        self.__resp_mv = memoryview(self.__resp_buf)
+        self.__cmd_buf = bytearray(LTEModule.COMMAND_BUFFER_SIZE)
+        self.__cmd_mv = memoryview(self.__cmd_buf)
+        # Set from the STATUS pin interrupt when the module gets ready. Only newer uasyncio provides ThreadSafeFlag.
+        self.__status_flag = asyncio.ThreadSafeFlag() if hasattr(asyncio, 'ThreadSafeFlag') else None
+        # Set from the UART interrupt when the RX line gets idle after receiving bytes.
+        self.__rx_flag = asyncio.ThreadSafeFlag() if hasattr(asyncio, 'ThreadSafeFlag') and hasattr(pyb.UART, 'IRQ_RXIDLE') else None
 
     def initialize(self) -> None:
         "Initialize I/O ports and peripherals to communicate with the module."
-        self.__l.debug('initialize')
+        _dbg('initialize')
         
         self.__pin_reset_module.init(pyb.Pin.OUT_PP)
         self.__pin_dtr_module.init(pyb.Pin.OUT_PP)
@@ -82,8 +176,13 @@ class LTEModule(object):
         self.__pin_reset_module.on()
         self.__pin_disable_module.on()
         self.__pin_wakeup_module.off()
+
+        if self.__status_flag is not None:
+            self.__pin_module_status.irq(self.__on_status_falling, trigger=pyb.Pin.IRQ_FALLING)
         
         self.__uart.init(baudrate=115200, timeout=5000, timeout_char=1000)
+        if self.__rx_flag is not None:
+            self.__uart.irq(self.__on_rx_idle, trigger=pyb.UART.IRQ_RXIDLE)
 
         
     def set_supply_power(self, to_supply:bool):
@@ -94,25 +193,49 @@ class LTEModule(object):
         "Reset the module."
         self.__pin_reset_module.off()
         await asyncio.sleep_ms(200)
-        while self.__uart.any():
-            self.__uart.read(self.__uart.any())
+        # Discard pending input through the staging buffer instead of allocating bytes for it.
+        available = self.__uart.any()
+        while available > 0:
+            self.__uart.readinto(self.__rx_mv, available if available < LTEModule.RX_STAGING_SIZE else LTEModule.RX_STAGING_SIZE)
+            available = self.__uart.any()
+        self.__rx_head = 0
+        self.__rx_tail = 0
         self.__pin_reset_module.on()
         await asyncio.sleep_ms(300)
 
-        for trial in range(15):
-            if await self.wait_response(b'RDY') is not None:
-                return True
+        if await self.wait_response(b'RDY', max_lines=15) is not None:
+            return True
         self.__l.info("The module did not respond within timeout period.")
         return False
 
+    def __on_status_falling(self, pin:pyb.Pin) -> None:
+        self.__status_flag.set()
+
+    def __on_rx_idle(self, uart:pyb.UART) -> None:
+        self.__rx_flag.set()
+
     async def wait_busy(self, max_trials:int=50) -> bool:
-        "Wait while the module is busy."
-        self.__l.debug('Waiting busy...')
+        "Wait while the module is busy. Waits up to max_trials*100 [ms]."
+        _dbg('Waiting busy...')
+        if self.__status_flag is not None:
+            # Sleep until the STATUS pin falls instead of polling it.
+            timeout = max_trials*100
+            start_time_ms = time.ticks_ms()
+            while self.is_busy():
+                remaining = timeout - time.ticks_diff(time.ticks_ms(), start_time_ms)
+                if remaining <= 0:
+                    _dbg('Failed.')
+                    return False
+                try:
+                    await asyncio.wait_for_ms(self.__status_flag.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            return True
         for trial in range(max_trials):
             if not self.is_busy():
                 return True
             await asyncio.sleep_ms(100)
-        self.__l.debug('Failed.')
+        _dbg('Failed.')
         return False
 
     async def turn_on(self) -> bool:
@@ -126,9 +249,8 @@ class LTEModule(object):
             self.__l.info("The module is still busy.")
             return False
 
-        for trial in range(15):
-            if await self.wait_response(b'RDY') is not None:
-                return True
+        if await self.wait_response(b'RDY', max_lines=15) is not None:
+            return True
         self.__l.info("The module did not respond within timeout period.")
         return False
 
@@ -146,22 +268,20 @@ class LTEModule(object):
         if not await self.write_command_wait(b'AT', b'OK'):    # Check if the module can accept commands.
             self.__l.info("The module did not respond.")
             return False
-        if not await self.write_command_wait(b'ATE0', b'OK'):  # Disable command echo
-            self.__l.info("Failed to disable command echo.")
-            return False
-        if not await self.write_command_wait(b'AT+QURCCFG="urcport","uart1"', b'OK'):  # Use UART1 port to receive URC
-            self.__l.info("Failed to configure the module UART port.")
+        # Disable command echo and use UART1 port to receive URC, concatenated into one command line as V.250 allows.
+        if not await self.write_command_wait(b'ATE0;+QURCCFG="urcport","uart1"', b'OK'):
+            self.__l.info("Failed to disable command echo or configure the module UART port.")
             return False
 
-        buffer = bytearray(1024)
-        result, responses = await self.execute_command(b'AT+QSCLK=1', buffer, expected_response_list=[b'OK', b'ERROR'])
+        buffer = self.__resp_buf
+        result, _ = await self.execute_command(b'AT+QSCLK=1', buffer, expected_response_predicate=_is_ok_or_error, collect_responses=False)
         if not result:
             return False
         
         self.__l.info('Waiting SIM goes active...')
         while True:
             result, responses = await self.execute_command(b'AT+CPIN?', buffer, timeout=1000)
-            self.__l.info('AT+CPIN result={0}, response={1}'.format(result, len(responses)))
+            self.__l.info('AT+CPIN result=%s, response=%d', result, len(responses))
             if len(responses) == 0: return False
             if result: 
                 
@@ -187,45 +307,25 @@ class LTEModule(object):
         response = await self.execute_command_single_response(b'AT+CSQ', b'+CSQ:')
         if response is None:
             return None
-        try:
-            s = str(response[5:], 'utf-8')
-            rssi, ber = s.split(',', 2)
-            return (int(rssi), int(ber))
-        except ValueError:
-            return None
+        return _parse_two_ints(response, 5)
     
     async def activate(self, access_point:str, user:str, password:str, timeout:int=None) -> bool:
         self.__l.info("Activating network...")
-        while True:
-            # Read network registration status.
-            response = await self.execute_command_single_response(b'AT+CGREG?', b'+CGREG:', timeout)
-            if response is None:
-                raise LTEModuleError('Failed to get registration status.')
-            s = str(response, 'utf-8')
-            self.__l.debug('AT+CGREG?:%s', s)
-            n, stat = s.split(',')[:2]
-            if stat == '0' or stat == '4':  # Not registered and not searching (0), or unknown (4).
-                raise LTEModuleError('Invalid registration status.')
-            elif stat == '1' or stat == '5': # Registered.
-                break
-        
-        while True:
-            # Read EPS network registration status
-            response = await self.execute_command_single_response(b'AT+CEREG?', b'+CEREG:', timeout)
-            if response is None:
-                raise LTEModuleError('Failed to get registration status.')
-            s = str(response, 'utf-8')
-            self.__l.debug('AT+CEREG?:%s', s)
-            n, stat = s.split(',')[:2]
-            if stat == '0' or stat == '4':  # Not registered and not searching (0), or unknown (4).
-                raise LTEModuleError('Invalid registration status.')
-            elif stat == '1' or stat == '5': # Registered.
-                break
+        # Report changes of the network registration status as URCs only while waiting for the registration.
+        if not await self.write_command_wait(b'AT+CGREG=1;+CEREG=1', b'OK', timeout):
+            return False
+        try:
+            # Wait for network registration, then EPS network registration.
+            await self.__wait_registration(b'AT+CGREG?', b'+CGREG: ', timeout)
+            await self.__wait_registration(b'AT+CEREG?', b'+CEREG: ', timeout)
+        finally:
+            # Otherwise the URCs would be taken as responses of other commands, such as AT+GSN.
+            await self.write_command_wait(b'AT+CGREG=0;+CEREG=0', b'OK', timeout)
         # Configure TCP/IP contect parameters
         # contextID,context_type,APN,username,password,authentication
         # context_type  : IPv4 = 1, IPv4/v6 = 2
         # authentication: None = 0, PAP = 1, CHAP = 2, PAP or CHAP = 3
-        command = bytes('AT+QICSGP=1,1,"{0}","{1}","{2}",1'.format(access_point, user, password), 'utf-8')
+        command = b''.join((b'AT+QICSGP=1,1,"', bytes(access_point, 'utf-8'), b'","', bytes(user, 'utf-8'), b'","', bytes(password, 'utf-8'), b'",1'))
         if not await self.write_command_wait(command, b'OK', timeout):
             return False
         # Activate a PDP context
@@ -236,6 +336,47 @@ class LTEModule(object):
         
         return True
     
+    async def __wait_registration(self, command:bytes, prefix:bytes, timeout:int) -> None:
+        """
+        Query the registration status, then follow the status URCs until the module gets registered.
+        The status is queried again whenever no URC arrives within timeout, so the wait itself has no deadline.
+        """
+        prefix_length = len(prefix)
+        while True:
+            result, responses = await self.execute_command(command, self.__resp_buf, timeout=timeout)
+            if not result:
+                raise LTEModuleError('Failed to get registration status.')
+            # A URC may arrive together with the response. The last status wins.
+            stat = -1
+            for response in responses:
+                if len(response) > prefix_length and match_prefix(response, 0, prefix, prefix_length):
+                    stat = _parse_registration_status(response)
+            while True:
+                if _DEBUG:
+                    _dbg('%s stat=%d', prefix, stat)
+                if stat <= 0 or stat == 4:  # Not registered and not searching (0), unknown (4) or malformed.
+                    raise LTEModuleError('Invalid registration status.')
+                elif stat == 1 or stat == 5: # Registered.
+                    return
+                response = await self.wait_response(prefix, timeout=timeout)
+                if response is None:
+                    break   # Still searching. Query the status again.
+                stat = _parse_registration_status(response)
+
+    async def set_low_latency_send(self, enable:bool, timeout:int=None) -> bool:
+        """
+        Keep the module ready to send data without any delay.
+
+        :param bool enable:     True to disable the module sleep and hold DTR low, False to allow the module to sleep again.
+        :return:                True if the module accepted the configuration.
+        """
+        if enable:
+            self.__pin_dtr_module.off()
+        # Exchange socket data as raw bytes so that the module passes each QISEND payload through as is.
+        if not await self.write_command_wait(b'AT+QICFG="dataformat",0,0', b'OK', timeout=timeout):
+            return False
+        return await self.write_command_wait(b'AT+QSCLK=0' if enable else b'AT+QSCLK=1', b'OK', timeout=timeout)
+
     async def get_ip_address(self, host:str, timeout:int=60*1000) -> List[str]:
         """
         Get IP address from hostname using DNS.
@@ -246,22 +387,21 @@ class LTEModule(object):
         """
         assert(host is not None)
         
-        await self.__process_remaining_urcs(timeout=timeout)
-
-        buffer = bytearray(1024)
+        if self.__urcs:
+            await self.__process_remaining_urcs(timeout=timeout)
 
         try:
             # Query host address.
-            self.__l.debug("Querying DNS: {0}".format(host))
-            command = bytes('AT+QIDNSGIP=1,"{0}"'.format(host), 'utf-8')
+            _dbg('Querying DNS: %s', host)
+            command = b''.join((b'AT+QIDNSGIP=1,"', bytes(host, 'utf-8'), b'"'))
             if not await self.write_command_wait(command, b'OK', timeout=timeout):
                 raise LTEModuleError('Failed to get IP.')
 
-            self.__l.debug("Waiting response...")
+            _dbg("Waiting response...")
             response = await self.wait_response(b'+QIURC: "dnsgip"', timeout=timeout) # type:bytes
             if response is None:
                 return None
-            self.__l.debug("QIURC: {0}".format(response))
+            _dbg('QIURC: %s', response)
             fields = str(response, 'utf-8').split(',')
 
             if len(fields) < 4 or int(fields[1]) != 0:
@@ -269,7 +409,7 @@ class LTEModule(object):
             count = int(fields[2])
             ipaddrs = []
             for i in range(count):
-                mv = await self.wait_response_into(b'+QIURC: "dnsgip",', response_buffer=buffer, timeout=1000)
+                mv = await self.wait_response_into(b'+QIURC: "dnsgip",', response_buffer=self.__resp_buf, timeout=1000)
                 if mv is not None:
                     ipaddrs.append(str(mv[18:-1], 'utf-8')) # strip double-quote
             return ipaddrs
@@ -293,16 +433,17 @@ class LTEModule(object):
         assert(host is not None)
         assert(port is not None and 0 <= port and port <= 65535)
         if socket_type == LTEModule.SOCKET_TCP:
-            socket_type_name = 'TCP'
+            socket_type_name = b'TCP'
         elif socket_type == LTEModule.SOCKET_UDP:
-            socket_type_name = 'UDP'
+            socket_type_name = b'UDP'
         else:
             socket_type_name = None
         assert(socket_type_name is not None)
 
-        await self.__process_remaining_urcs(timeout=timeout)
+        if self.__urcs:
+            await self.__process_remaining_urcs(timeout=timeout)
 
-        buffer = bytearray(1024)
+        buffer = self.__resp_buf
 
         # new_connect_id = None
         # for connect_id in range(LTEModule.MAX_CONNECT_ID):
@@ -316,37 +457,35 @@ class LTEModule(object):
         success, responses = await self.execute_command(b'AT+QISTATE?', buffer, timeout=timeout)
         if not success:
             raise LTEModuleError('Failed to get socket status')
-        connect_id_in_use = set()
+        used_mask = self.__connection_mask
         for response in responses:
-            if len(response) < 10 or response[:10] != b'+QISTATE: ': continue
-            s = str(bytes(response[10:]), 'utf-8')
-            self.__l.info(s)
-            params = s.split(',',1)
-            connect_id = int(params[0])
-            connect_id_in_use.add(connect_id)
-# 
-        new_connect_id = None
-        for connect_id in range(LTEModule.MAX_CONNECT_ID):
-            if connect_id not in connect_id_in_use and connect_id not in self.__connections:
-                new_connect_id = connect_id
-                break
-        if new_connect_id is None:
+            # +QISTATE: <connectID>,...  where connectID has at most 2 digits.
+            if len(response) < 11 or not match_prefix(response, 0, b'+QISTATE: ', 10): continue
+            connect_id = response[10] - 0x30
+            if len(response) > 11 and response[11] != 0x2c:
+                connect_id = connect_id*10 + response[11] - 0x30
+            used_mask |= 1 << connect_id
+
+        free_mask = ((1 << LTEModule.MAX_CONNECT_ID) - 1) & ~used_mask
+        if free_mask == 0:
             raise LTEModuleError('No connection resources available.')
+        connect_id = _BIT_POSITION[(free_mask & -free_mask) % 37]    # Lowest unused connection ID.
 
         # Open socket.
-        self.__l.info('Connecting[id={0}] {1}:{2}'.format(connect_id, host, port))
-        command = bytes('AT+QIOPEN=1,{0},"{1}","{2}",{3},0,0'.format(connect_id, socket_type_name, host, port), 'utf-8')
+        self.__l.info('Connecting[id=%d] %s:%d', connect_id, host, port)
+        command = b''.join((b'AT+QIOPEN=1,%d,"' % connect_id, socket_type_name, b'","', bytes(host, 'utf-8'), b'",%d,0,0' % port))
         if not await self.write_command_wait(command, b'OK', timeout=timeout):
             raise LTEModuleError('Failed to open socket. OK')
-        response = await self.wait_response(bytes('+QIOPEN: {0},'.format(connect_id), 'utf-8'), timeout=timeout)
+        prefix = _QIOPEN_RESULT_BY_ID[connect_id]
+        response = await self.wait_response(prefix, timeout=timeout)
         if response is None:
             raise LTEModuleError('Failed to open socket. QIOPEN')
-        error = str(response, 'utf-8').split(',')[1]
-        if error != '0':
+        error = parse_uint(response, len(prefix), len(response))
+        if error != 0:
             raise LTEModuleError('Failed to open socket. error={0}'.format(error))
 
-        self.__l.info('Connected[id={0}]'.format(connect_id))
-        self.__connections.append(connect_id)
+        self.__l.info('Connected[id=%d]', connect_id)
+        self.__connection_mask |= 1 << connect_id
         return connect_id
         
 
@@ -355,8 +494,9 @@ class LTEModule(object):
         Send a packet to destination.
         """
         assert(0 <= connect_id and connect_id <= LTEModule.MAX_CONNECT_ID)
-        await self.__process_remaining_urcs(timeout=timeout)
-        if connect_id not in self.__connections:
+        if self.__urcs:
+            await self.__process_remaining_urcs(timeout=timeout)
+        if not (self.__connection_mask >> connect_id) & 1:
             return False
         
         length = len(data) if length is None else length
@@ -364,18 +504,44 @@ class LTEModule(object):
             return True
         assert(length <= LTEModule.MAX_SOCKET_DATA_SIZE)
 
-        command = bytes('AT+QISEND={0},{1}'.format(connect_id, length), 'utf-8')
+        command = _QISEND_BY_ID[connect_id] + b'%d' % length
         self.write_command(command)
         if not await self.wait_prompt(b'> ', timeout=timeout):
             return False
-        mv = memoryview(data)
-        self.__uart.write(mv[offset:offset+length])
+        self.__write_payload(data, offset, length)
+        return await self.wait_response(b'SEND OK', timeout=timeout) is not None
+
+    async def socket_send_batch(self, connect_id:int, chunks:List[bytes], timeout:int=None) -> bool:
+        """
+        Send several buffers as a single packet with one AT+QISEND round-trip.
+        """
+        assert(0 <= connect_id and connect_id <= LTEModule.MAX_CONNECT_ID)
+        if self.__urcs:
+            await self.__process_remaining_urcs(timeout=timeout)
+        if not (self.__connection_mask >> connect_id) & 1:
+            return False
+
+        length = 0
+        for chunk in chunks:
+            length += len(chunk)
+        if length == 0:
+            return True
+        assert(length <= LTEModule.MAX_SOCKET_DATA_SIZE)
+
+        command = _QISEND_BY_ID[connect_id] + b'%d' % length
+        self.write_command(command)
+        if not await self.wait_prompt(b'> ', timeout=timeout):
+            return False
+        write_payload = self.__write_payload
+        for chunk in chunks:
+            write_payload(chunk, 0, len(chunk))
         return await self.wait_response(b'SEND OK', timeout=timeout) is not None
     
     async def socket_receive(self, connect_id:int, buffer:bytearray, offset:int=0, length:int=None, timeout:int=None) -> int:
         assert(0 <= connect_id and connect_id <= LTEModule.MAX_CONNECT_ID)
-        await self.__process_remaining_urcs(timeout=timeout)
-        if connect_id not in self.__connections:
+        if self.__urcs:
+            await self.__process_remaining_urcs(timeout=timeout)
+        if not (self.__connection_mask >> connect_id) & 1:
             return False
         
         length = len(buffer) if length is None else length
@@ -383,110 +549,230 @@ class LTEModule(object):
             return True
         assert(length <= LTEModule.MAX_SOCKET_DATA_SIZE)
 
-        command = bytes('AT+QIRD={0},{1}'.format(connect_id,length), 'utf-8')
+        self.__receive_pending &= ~(1 << connect_id)
+        command = _QIRD_BY_ID[connect_id] + b'%d' % length
         self.write_command(command)
         response = await self.wait_response(b'+QIRD: ', timeout=timeout)
         if response is None:
             return None
-        actual_length = int(str(response[7:], 'utf-8'))
-        # self.__l.debug('receive length=%d', actual_length)
+        actual_length = parse_uint(response, 7, len(response))
+        if actual_length < 0:
+            return None
+        if _DEBUG:
+            _dbg('receive length=%d', actual_length)
         if actual_length == 0:
+            if self.__consume_staged(_QIRD_EMPTY_TRAILER):
+                return 0
             return 0 if await self.wait_response(b'OK', timeout=timeout) is not None else None
         mv = memoryview(buffer)
-        bytes_read = self.__uart.readinto(mv[offset:offset+length], actual_length)
-        # self.__l.debug('bytes read=%d', bytes_read)
-        # self.__l.debug('bytes=%s', buffer[offset:offset+length])
-        return actual_length if bytes_read == actual_length and await self.wait_response(b'OK', timeout=timeout) is not None else None
+        bytes_read = self.__read_raw_into(mv[offset:offset+length], actual_length)
+        if _DEBUG:
+            _dbg('bytes read=%d', bytes_read)
+            _dbg('bytes=%s', buffer[offset:offset+length])
+        if bytes_read != actual_length:
+            return None
+        # The final OK usually follows the payload immediately. Take it without another response scan if it is already there.
+        if self.__consume_staged(_QIRD_TRAILER):
+            return actual_length
+        return actual_length if await self.wait_response(b'OK', timeout=timeout) is not None else None
     
+    async def socket_wait_receive(self, connect_id:int, timeout:int=None) -> bool:
+        """
+        Wait until the module reports that data has arrived on a connection.
+
+        :param int connect_id:  Connection ID returned by socket_open.
+        :param int timeout:     Timeout in [ms]. None to wait forever.
+        :return:                True if data is ready to be read by socket_receive, otherwise False.
+        """
+        assert(0 <= connect_id and connect_id <= LTEModule.MAX_CONNECT_ID)
+        mask = 1 << connect_id
+        buffer = self.__resp_buf
+        start_time_ms = time.ticks_ms()
+        while not self.__receive_pending & mask:
+            if not self.socket_is_connected(connect_id):
+                return False
+            remaining = None if timeout is None else timeout - time.ticks_diff(time.ticks_ms(), start_time_ms)
+            if remaining is not None and remaining <= 0:
+                return False
+            # Check the pending flag after every line, since the recv URC is handled without returning from read_response_into.
+            # Any response other than URCs is discarded here, as wait_response does.
+            length = await self.__read_response_into(buffer, 0, remaining)
+            if length is None:
+                return False
+            self.__handle_urc(buffer, 0, length)
+        self.__receive_pending &= ~mask
+        return True
+
     async def socket_close(self, connect_id:int, timeout:int=None) -> bool:
         assert(0 <= connect_id and connect_id <= LTEModule.MAX_CONNECT_ID)
-        if connect_id not in self.__connections:
+        if not (self.__connection_mask >> connect_id) & 1:
             return False
-        self.__l.info('Closing connection {0}'.format(connect_id))
-        command = bytes('AT+QICLOSE={0}'.format(connect_id), 'utf-8')
-        await self.write_command_wait(command, expected_response=b'OK', timeout=timeout)
-        self.__l.info('Closed connection {0}'.format(connect_id))
-        self.__connections.remove(connect_id)
+        self.__l.info('Closing connection %d', connect_id)
+        await self.write_command_wait(_QICLOSE_BY_ID[connect_id], expected_response=b'OK', timeout=timeout)
+        self.__l.info('Closed connection %d', connect_id)
+        self.__connection_mask &= ~(1 << connect_id)
+        self.__receive_pending &= ~(1 << connect_id)
         return True
     
     def socket_is_connected(self, connect_id:int) -> bool:
-        return connect_id in self.__connections and ("closed", connect_id) not in self.__urcs
+        return bool((self.__connection_mask >> connect_id) & 1) and ("closed", connect_id) not in self.__urcs
 
     def is_busy(self) -> bool:
         return bool(self.__pin_module_status.value())
 
     def write(self, s:bytes) -> None:
-        self.__l.debug('<- ' + s)
+        if _DEBUG:
+            _dbg('<- %s', s)
         self.__uart.write(s)
     
+    def __write_payload(self, data:bytes, offset:int, length:int) -> None:
+        "Write data[offset:offset+length] to the UART without yielding, so that nothing else gets into the payload of AT+QISEND."
+        self.__uart.write(data if offset == 0 and length == len(data) else memoryview(data)[offset:offset+length])
+
     def read(self, length:int) -> bytes:
-        return self.__uart.read(length)
+        buffer = bytearray(length)
+        length = self.__read_raw_into(memoryview(buffer), length)
+        return bytes(buffer[:length])
     
     def write_command(self, command:bytes) -> None:
-        self.__l.debug('<- %s', command)
-        self.__uart.write(command)
-        self.__uart.write('\r')
+        if _DEBUG:
+            _dbg('<- %s', command)
+        length = len(command)
+        if length < LTEModule.COMMAND_BUFFER_SIZE:
+            # Send the command and the terminating CR by one write.
+            self.__cmd_buf[:length] = command
+            self.__cmd_buf[length] = _CR
+            self.__uart.write(self.__cmd_mv[:length+1])
+        else:
+            self.__uart.write(command)
+            self.__uart.write(b'\r')
 
     async def write_command_wait(self, command:bytes, expected_response:bytes, timeout:int=None) -> bool:
-        self.write_command(command)
-        return await self.wait_response(expected_response, timeout=timeout) is not None
+        if expected_response == b'OK':
+            result, _ = await self.execute_command(command, self.__resp_buf, expected_response_predicate=_is_ok, timeout=timeout, collect_responses=False)
+        else:
+            result, _ = await self.execute_command(command, self.__resp_buf, expected_response_list=(expected_response,), timeout=timeout, collect_responses=False)
+        return result
 
 
     async def read_response_into(self, buffer:bytearray, offset:int=0, timeout:int=None) -> int:
+        "Read a response into buffer[offset:] and return its length, handling the URCs received before it. None if timed out."
         while True:
             length = await self.__read_response_into(buffer=buffer, offset=offset, timeout=timeout)
-            mv = memoryview(buffer)
-            if length is not None and length >= 8 and mv[0:8] == b"+QIURC: ":
-                #self.__l.info("URC: {0}".format(str(mv[:length], 'utf-8')))
-                if length > 17 and mv[8:16] == b'"closed"':
-                    connect_id = int(str(mv[17:length], 'utf-8'))
-                    self.__l.info("Connection {0} closed".format(connect_id))
-                    self.__urcs.append( ("closed", connect_id) )
-                    continue
-            
+            if length is not None and self.__handle_urc(buffer, offset, length):
+                continue
             return length
+
+    def __handle_urc(self, buffer:bytearray, offset:int, length:int) -> bool:
+        "Record the connection URC in buffer[offset:offset+length]. Returns True if it was a URC handled here."
+        if length < 8 or not match_prefix(buffer, offset, b"+QIURC: ", 8):
+            return False
+        if _DEBUG:
+            _dbg('URC: %s', str(memoryview(buffer)[offset:offset+length], 'utf-8'))
+        if length > 17 and match_prefix(buffer, offset+8, b'"closed"', 8):
+            connect_id = parse_uint(buffer, offset+17, offset+length)
+            self.__l.info("Connection %d closed", connect_id)
+            self.__urcs.append( ("closed", connect_id) )
+            return True
+        if length > 15 and match_prefix(buffer, offset+8, b'"recv"', 6):
+            connect_id = parse_uint(buffer, offset+15, offset+length)
+            self.__receive_pending |= 1 << connect_id
+            return True
+        return False
     
 
+    def __fill_rx(self, count:int=1) -> int:
+        "Move the bytes available in the UART into the staging buffer if at least count bytes can be staged. Returns the number of bytes staged."
+        head = self.__rx_head
+        staged = self.__rx_tail - head
+        if staged >= count:
+            return staged
+        available = self.__uart.any()
+        if staged + available < count:
+            return staged
+        if staged > 0:
+            # Copy through the memoryview so that the compaction does not allocate. The destination precedes the source, so a forward copy is safe.
+            self.__rx_buf[0:staged] = self.__rx_mv[head:head+staged]
+        if available > LTEModule.RX_STAGING_SIZE - staged:
+            available = LTEModule.RX_STAGING_SIZE - staged
+        n = self.__uart.readinto(self.__rx_mv[staged:staged+available])
+        self.__rx_head = 0
+        self.__rx_tail = staged + (n if n is not None else 0)
+        return self.__rx_tail
+
+    def __consume_staged(self, expected:bytes) -> bool:
+        "Consume expected if it has already been received and comes next. Does not wait for the UART."
+        length = len(expected)
+        if self.__fill_rx(length) < length:
+            return False
+        head = self.__rx_head
+        if not match_prefix(self.__rx_buf, head, expected, length):
+            return False
+        self.__rx_head = head + length
+        return True
+
+    async def __wait_rx(self, start_time_ms:int, timeout:int) -> bool:
+        "Wait until the UART receives more bytes. Returns False if timed out."
+        wait_ms = LTEModule.RX_WAIT_INTERVAL
+        if timeout is not None:
+            remaining = timeout - time.ticks_diff(time.ticks_ms(), start_time_ms)
+            if remaining <= 0:
+                return False
+            if remaining < wait_ms:
+                wait_ms = remaining
+        if self.__rx_flag is None:
+            # No interrupt to wait for. Just yield to the other tasks and check the UART again on the next turn.
+            await asyncio.sleep_ms(0)
+            return True
+        # The wait is capped by RX_WAIT_INTERVAL so that the bytes arrived without an idle interrupt are picked up anyway.
+        try:
+            await asyncio.wait_for_ms(self.__rx_flag.wait(), wait_ms)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+    def __read_raw_into(self, mv:memoryview, length:int) -> int:
+        "Read raw bytes, consuming the staged bytes first."
+        head = self.__rx_head
+        staged = self.__rx_tail - head
+        if staged > length:
+            staged = length
+        if staged > 0:
+            mv[:staged] = self.__rx_mv[head:head+staged]
+            self.__rx_head = head + staged
+        if staged == length:
+            return length
+        n = self.__uart.readinto(mv[staged:length], length - staged)
+        return staged + (n if n is not None else 0)
+
     async def __read_response_into(self, buffer:bytearray, offset:int=0, timeout:int=None) -> int:
-        buffer_length = len(buffer)
-        response_length = 0
-        state = 0
+        assert(offset < len(buffer))    # scan_frame does not check the bounds of the buffer.
+        rx = self.__rx_buf
+        fill_rx = self.__fill_rx
+        wait_rx = self.__wait_rx
+        scan = scan_frame
+        ctx = self.__scan_ctx
+        ctx[CTX_STATE] = 0
+        ctx[CTX_LENGTH] = 0
+        ctx[CTX_OFFSET] = offset
+        ctx[CTX_LIMIT] = len(buffer)
         start_time_ms = time.ticks_ms()
         while True:
-            c = self.__uart.readchar()
-            if c < 0:
-                if timeout is not None and (time.ticks_ms()-start_time_ms) >= timeout:
-                    return None
-                try:
-                    await asyncio.sleep_ms(1)
-                except asyncio.CancelledError:
-                    return None
+            if self.__rx_head == self.__rx_tail:
+                if fill_rx() == 0:
+                    try:
+                        if not await wait_rx(start_time_ms, timeout):
+                            return None
+                    except asyncio.CancelledError:
+                        return None
                 continue
             
-            #self.__l.debug('S:%d R:%c', state, c)
-            if state == 0 and c == LTEModule.CR:
-                state = 1
-            elif state == 1 and c == LTEModule.LF:
-                state = 2
-            elif state == 1 and c == LTEModule.CR:
-                state = 1
-            elif state == 1 and c != LTEModule.LF:
-                response_length = 0
-                state = 0
-            elif state == 2 and c == LTEModule.CR:
-                if response_length == 0:
-                    state = 1   # Maybe there is another corresponding CR-LF followed by actual response data. So we have to return to state 1.
-                else:
-                    state = 4
-            elif state == 2 and c != LTEModule.CR:
-                buffer[offset+response_length] = c
-                response_length += 1
-                if offset+response_length == buffer_length:
-                    state = 3
-            elif state == 3 and c == LTEModule.CR:
-                state = 4
-            elif state == 4 and c == LTEModule.LF:
-                return response_length
+            ctx[CTX_HEAD] = self.__rx_head
+            ctx[CTX_TAIL] = self.__rx_tail
+            done = scan(rx, buffer, ctx)
+            self.__rx_head = ctx[CTX_HEAD]
+            if done:
+                return ctx[CTX_LENGTH]
     
     async def __process_remaining_urcs(self, timeout:int=None):
         for urc_type, urc_params in self.__urcs:
@@ -494,79 +780,140 @@ class LTEModule(object):
                 await self.socket_close(urc_params, timeout=timeout)
         self.__urcs.clear()
     
-    async def wait_response(self, expected_response:bytes, max_response_size:int=1024, timeout:int=None) -> bytes:
-        self.__l.debug('wait_response: target=%s', expected_response)
-        response = bytearray(max_response_size)
+    async def wait_response(self, expected_response:bytes, max_response_size:int=1024, timeout:int=None, max_lines:int=None) -> memoryview:
+        """
+        Wait for a response which starts with expected_response.
+
+        :param bytes expected_response: Prefix of the response to wait for. Other responses are discarded.
+        :param int max_response_size:   Maximum length of the response. The shared response buffer is used unless it is too small.
+        :param int timeout:             Timeout in [ms]. None to wait forever.
+        :param int max_lines:           Maximum number of responses to read. None to read until the expected one arrives.
+        :return:                        A memoryview of the response, which is valid only until the next command. None if timed out.
+        """
+        if _DEBUG:
+            _dbg('wait_response: target=%s', expected_response)
+        if max_response_size <= LTEModule.RESPONSE_BUFFER_SIZE:
+            response = self.__resp_buf
+            mv = self.__resp_mv
+        else:
+            response = bytearray(max_response_size)
+            mv = memoryview(response)
         expected_length = len(expected_response)
+        first_byte = expected_response[0] if expected_length > 0 else -1
+        read_response_into = self.read_response_into
         while True:
-            length = await self.read_response_into(response, timeout=timeout)
+            length = await read_response_into(response, timeout=timeout)
             if length is None: return None
-            self.__l.debug("wait_response: response=%s", response[:length])
-            if length >= expected_length and response[:expected_length] == expected_response:
-                return response[:length]
+            if _DEBUG:
+                _dbg("wait_response: response=%s", mv[:length])
+            # Most unrelated responses are rejected by the first byte without slicing.
+            if expected_length == 0 or (length >= expected_length and response[0] == first_byte and match_prefix(response, 0, expected_response, expected_length)):
+                return mv[:length]
+            if max_lines is not None:
+                max_lines -= 1
+                if max_lines <= 0:
+                    return None
     
     async def wait_response_into(self, expected_response:bytes, response_buffer:bytearray, timeout:int=None) -> memoryview:
-        self.__l.debug('wait_response_into: target=%s', expected_response)
+        if _DEBUG:
+            _dbg('wait_response_into: target=%s', expected_response)
         expected_length = len(expected_response)
-        mv = memoryview(response_buffer)
+        first_byte = expected_response[0] if expected_length > 0 else -1
+        mv = self.__resp_mv if response_buffer is self.__resp_buf else memoryview(response_buffer)
+        read_response_into = self.read_response_into
         while True:
-            length = await self.read_response_into(response_buffer, timeout=timeout)
+            length = await read_response_into(response_buffer, timeout=timeout)
             if length is None: return None
-            self.__l.debug("wait_response_into: response=%s", str(mv[:length], 'utf-8'))
-            if length >= expected_length and mv[:expected_length] == expected_response:
+            if _DEBUG:
+                _dbg("wait_response_into: response=%s", str(mv[:length], 'utf-8'))
+            if expected_length == 0 or (length >= expected_length and response_buffer[0] == first_byte and match_prefix(response_buffer, 0, expected_response, expected_length)):
                 return mv[:length]
 
     async def wait_prompt(self, expected_prompt:bytes, timeout:int=None) -> bool:
         prompt_length = len(expected_prompt)
-        index = 0
+        rx_buf = self.__rx_buf
+        fill_rx = self.__fill_rx
+        wait_rx = self.__wait_rx
         start_time_ms = time.ticks_ms()
     
         while True:
-            c = self.__uart.readchar()
-            if c < 0:
-                if time.ticks_ms() - start_time_ms > timeout:
+            # Wait until a whole prompt-sized window is staged.
+            if fill_rx(prompt_length) < prompt_length:
+                if not await wait_rx(start_time_ms, timeout):
                     return False
-                await asyncio.sleep_ms(1)
                 continue
-            if expected_prompt[index] == c:
-                index += 1
-                if index == prompt_length:
-                    return True
-            else:
-                index = 0
+            head = self.__rx_head
+            if match_prefix(rx_buf, head, expected_prompt, prompt_length):
+                self.__rx_head = head + prompt_length
+                return True
+            if rx_buf[head] == 0x2b:
+                # A line starting with '+' may be a URC, which must not be lost. Handle it once the whole line is staged.
+                tail = self.__rx_tail
+                end = find_byte(rx_buf, head, tail, _CR)
+                if end >= 0:
+                    self.__handle_urc(rx_buf, head, end - head)
+                    self.__rx_head = end
+                    continue
+                staged = tail - head
+                if staged < LTEModule.RX_STAGING_SIZE:
+                    if fill_rx(staged + 1) <= staged and not await wait_rx(start_time_ms, timeout):
+                        return False
+                    continue
+                # The line does not fit in the staging buffer, so it cannot be a URC handled here.
+            # Something else precedes the prompt. Shift the window by one byte.
+            self.__rx_head = head + 1
         
-    async def execute_command(self, command:bytes, response_buffer:bytearray, index:int=0, expected_response_predicate:Callable[[memoryview],bool]=None, expected_response_list:List[bytes]=[b'OK'], timeout:int=None) -> Tuple[bool, List[memoryview]]:
-        assert expected_response_predicate is not None or expected_response_list is not None
-        if expected_response_predicate is None:
-            expected_response_predicate = lambda mv: mv in expected_response_list 
+    async def execute_command(self, command:bytes, response_buffer:bytearray, index:int=0, expected_response_predicate:Callable[[memoryview],bool]=None, expected_response_list:List[bytes]=None, timeout:int=None, collect_responses:bool=True) -> Tuple[bool, List[memoryview]]:
+        """
+        Execute a command and read responses until one of them satisfies the predicate,
+        or equals one of expected_response_list ([b'OK'] by default) if no predicate is given.
+        If collect_responses is False, every response is read into response_buffer[index:] and only the last response is returned in the list.
+        """
+        if expected_response_predicate is None and expected_response_list is None:
+            expected_response_predicate = _is_ok
+        elif expected_response_predicate is None:
+            expected = tuple(expected_response_list)
+            expected_lengths = tuple(len(e) for e in expected)
+            def expected_response_predicate(mv:memoryview) -> bool:
+                length = len(mv)
+                for i in range(len(expected)):
+                    if length == expected_lengths[i] and mv == expected[i]:
+                        return True
+                return False
         self.write_command(command)
+        responses = [] if collect_responses else None
         buffer_length = len(response_buffer)
-        responses = []
         mv = memoryview(response_buffer)
+        read_response_into = self.read_response_into
         while True:
-            length = await self.read_response_into(response_buffer, index, timeout=timeout)
+            length = await read_response_into(response_buffer, index, timeout=timeout)
             if length is None:
-                return (False, responses)
+                return (False, responses if collect_responses else [])
             response = mv[index:index+length]
-            responses.append(response)
+            if collect_responses:
+                responses.append(response)
+                index += length
             if expected_response_predicate(response):
-                return (True, responses)
-            index += length
+                return (True, responses if collect_responses else [response])
+            if index >= buffer_length:
+                # No room left for the next response without overwriting the collected ones.
+                return (False, responses)
 
     async def execute_command_single_response(self, command:bytes, starts_with:bytes=None, timeout:int=None) -> bytes:
-        buffer = bytearray(1024)
-        result, responses = await self.execute_command(command, buffer, timeout=timeout)
+        result, responses = await self.execute_command(command, self.__resp_buf, timeout=timeout)
         if not result: return None
         starts_with_length = len(starts_with) if starts_with is not None else 0
 
         for response in responses:
             if starts_with_length == 0 and len(response) > 0:
                 response = bytes(response)
-                self.__l.debug('-> %s', response)
+                if _DEBUG:
+                    _dbg('-> %s', response)
                 return response
-            if starts_with_length > 0 and len(response) >= starts_with_length and response[:starts_with_length] == starts_with:
+            if starts_with_length > 0 and len(response) >= starts_with_length and match_prefix(response, 0, starts_with, starts_with_length):
                 response = bytes(response)
-                self.__l.debug('-> %s', response)
+                if _DEBUG:
+                    _dbg('-> %s', response)
                 return response
         return None
         